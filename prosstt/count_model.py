@@ -43,8 +43,8 @@ def generate_negbin_params(tree, mean_alpha=0.2, mean_beta=2, a_scale=1.5, b_sca
     s2_a = np.log(a_scale)
     mu_b = np.log(mean_beta)
     s2_b = np.log(b_scale)
-    alphas = np.exp(sp.stats.norm.rvs(loc=mu_a, scale=s2_a, size=tree.G))
-    betas = np.exp(sp.stats.norm.rvs(loc=mu_b, scale=s2_b, size=tree.G)) + 1
+    alphas = np.exp(np.random.normal(loc=mu_a, scale=s2_a, size=tree.G))
+    betas = np.exp(np.random.normal(loc=mu_b, scale=s2_b, size=tree.G)) + 1
     return alphas, betas
 
 
@@ -130,7 +130,7 @@ def get_pr_amp(mu_amp, s2_amp, ksi):
 
 def get_pr_umi(a, b, m):
     """
-    Calculate parameters for my_negbin from the mean and variance of the
+    Calculate parameters for sample_negbin from the mean and variance of the
     distribution.
 
     For single cell RNA sequencing data we assume that the distribution of the
@@ -163,7 +163,7 @@ def get_pr_umi(a, b, m):
 
 def get_pr_umi_atom(a, b, m):
     """
-    Calculate parameters for my_negbin from the mean and variance of the
+    Calculate parameters for sample_negbin from the mean and variance of the
     distribution.
 
     For single cell RNA sequencing data we assume that the distribution of the
@@ -194,17 +194,32 @@ def get_pr_umi_atom(a, b, m):
     return p, r
 
 
-class my_negbin(sp.stats.rv_discrete):
-    """
-    Class definition for the alternative negative binomial pmf so that we can
-    sample it using rvs().
+def sample_negbin(p, r):
     """
+    Draw counts from the alternative formulation of the negative binomial
+    distribution (see negbin). It has mean r*p/(1-p) and is the same
+    distribution as numpy's negative binomial with n=r and success
+    probability 1-p, so the sampling is delegated to numpy.
 
-    def _pmf(self, x, p, r):
-        theta = [p, r]
-        res = np.exp(lognegbin(x, theta))
-        res = np.real(res)
-        return res.astype("float")
+    Parameters
+    ----------
+    p: real array
+        The probability of success of the Bernoulli test.
+    r: real array
+        The number of "failures" of the Bernoulli test.
+
+    Returns
+    -------
+    counts: int array
+        One draw for each (p, r) pair. Pairs with r == 0 (mean expression of
+        zero) always yield 0.
+    """
+    p = np.asarray(p)
+    r = np.asarray(r)
+    counts = np.zeros(r.shape, dtype=int)
+    nonzero = r > 0
+    counts[nonzero] = np.random.negative_binomial(r[nonzero], 1 - p[nonzero])
+    return counts
 
 
 class sum_negbin(sp.stats.rv_discrete):
@@ -16,14 +16,22 @@
 
 import numpy as np
 from numpy import random
-import scipy as sp
 
 
-def print_progress(iteration, total, prefix='', suffix='', decimals=1):
+def print_progress(iteration, total, prefix='', suffix='', decimals=1,
+                   last_drawn=None):
     """
     Call in a loop to create a terminal-friendly text progress bar. Contributed
     by Greenstick on stackoverflow.com/questions/3173320.
 
+    To limit writes to stdout, pass the value returned by the previous call as
+    last_drawn: the bar is then only redrawn when the completed whole
+    percentage changes, i.e. at most ~100 times per loop::
+
+        drawn = None
+        for n in range(total + 1):
+            drawn = print_progress(n, total, last_drawn=drawn)
+
     Parameters
     ----------
         iteration: int
@@ -36,7 +44,18 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1):
             Suffix string after the progress bar.
         decimals: int, optional
             Positive number of decimals in percent complete.
+        last_drawn: int, optional
+            Whole percentage returned by the previous call. If None, the bar is
+            always redrawn.
+
+    Returns
+    -------
+        drawn: int
+            The whole percentage the bar currently shows.
     """
+    whole_percent = int(100 * iteration / float(total))
+    if 0 < iteration < total and whole_percent == last_drawn:
+        return last_drawn
     bar_length = 80
     format_str = "{0:." + str(decimals) + "f}"
     percent = format_str.format(100 * (iteration / float(total)))
@@ -47,6 +66,7 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1):
     if iteration == total:
         sys.stdout.write('\n')
     sys.stdout.flush()
+    return whole_percent
 
 
 def random_partition(k, iterable):
@@ -86,12 +106,58 @@ def test_correlation(W, k, cutoff):
     cutoff: float
         Correlation above the cut-off will be considered too much. Should be
         between 0 and 1 but is not explicitly tested.
+
+    Returns
+    -------
+    bool
+        Whether any of the previous columns correlates with column k.
+    """
+    if k == 0:
+        return False
+    normalized = normalize_rows(W[:k + 1])
+    return bool(max_correlation(normalized[:k], normalized[k]) > cutoff)
+
+
+def max_correlation(normalized, candidate):
     """
-    for i in range(k - 1, 0):
-        pearson_r = sp.stats.pearsonr(W[k], W[i])
-        if pearson_r[0] > cutoff:
-            return True
-    return False
+    Highest pearson correlation coefficient between a candidate row and all
+    rows of a matrix. Both have to be centered and normalized beforehand (see
+    normalize_rows).
+
+    Parameters
+    ----------
+    normalized: numpy array
+        The normalized rows to compare against.
+    candidate: numpy array
+        The normalized row to test.
+
+    Returns
+    -------
+    float
+        The highest correlation, or -1 if there are no rows to compare against.
+    """
+    return np.max(np.dot(normalized, candidate), initial=-1.)
+
+
+def normalize_rows(W):
+    """
+    Center and L2-normalize each row of a matrix. The pearson correlation
+    coefficient of two rows is the dot product of their normalized versions.
+    Rows with zero variance become NaN.
+
+    Parameters
+    ----------
+    W: numpy array
+        The matrix to normalize.
+
+    Returns
+    -------
+    normalized: numpy array
+        The centered rows of W, scaled to unit length.
+    """
+    centered = W - np.mean(W, axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return centered / np.linalg.norm(centered, axis=-1, keepdims=True)
 
 
 def create_groups(no_programs, no_genes):
@@ -110,35 +176,42 @@ def create_groups(no_programs, no_genes):
 
     Returns
     -------
-    groups: list of ints
+    groups: list of int arrays
         A list of the two modules to which each gene belongs.
     """
-    genes = random.permutation(no_genes)
     # we want each gene to appear in two groups, in average.
     # If we draw twice it will happen that some genes will take the same
     # group twice, but it should not happen too often.
-    groups1 = random_partition(no_programs, genes)
     # performing the permutation a second time is necessary, else most genes
     # will be in the same modules and we want to mix more
-    genes = random.permutation(no_genes)
-    groups2 = random_partition(no_programs, genes)
-    groups = [[i for subz in z for i in subz] for z in zip(groups1, groups2)]
+    genes = np.concatenate([random.permutation(no_genes),
+                            random.permutation(no_genes)])
+    modules = random.randint(no_programs, size=2 * no_genes)
+    # a stable sort keeps the genes of each module in permutation order
+    order = np.argsort(modules, kind="stable")
+    counts = np.bincount(modules, minlength=no_programs)
+    groups = np.split(genes[order], np.cumsum(counts)[:-1])
     return groups
 
 
 def bifurc_adjust(child, parent):
     """
     Adjust two matrices so that the last line of one equals the first of the
-    other.
+    other. The child matrix is modified in place.
 
     Parameters
     ----------
     child: matrix to be adjusted
 
     parent: matrix to adjust to
+
+    Returns
+    -------
+    child: numpy.ndarray
+        The adjusted child matrix (the same object that was passed).
     """
     dif = child[0] - parent[-1]
-    child = child - dif
+    np.subtract(child, dif, out=child)
     return child
 
 
@@ -161,10 +234,11 @@ def pearson_between_programs(genes, prog1, prog2):
     pearson: numpy.ndarray
         The pearson correlation coefficient for all genes in the two programs
     """
-    pearson = np.zeros(genes)
     common = min(prog1.shape[0], prog2.shape[0])
-    for gene in range(genes):
-        pearson[gene] = sp.stats.pearsonr(prog1[:common, gene], prog2[:common, gene])[0]
+    # one row per gene; the coefficient is the dot product of normalized rows
+    norm1 = normalize_rows(np.transpose(prog1[:common, :genes]).astype(float))
+    norm2 = normalize_rows(np.transpose(prog2[:common, :genes]).astype(float))
+    pearson = np.sum(norm1 * norm2, axis=1)
     return pearson
 
 
@@ -253,6 +327,26 @@ def diverging_parallel(branches, programs, genes, tol=0.5):
 
 
 def commited_branches(tree, branches, rel_means):
+    """
+    Blend the relative mean expression of two parallel branches during the
+    timezone they share, so that cells are not yet fully committed to either
+    branch. The weight of the other branch decreases linearly from almost
+    one half to zero over the shared timezone.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree object.
+    branches: list
+        The two parallel branches to blend.
+    rel_means: Series
+        Relative mean expression for all genes on every lineage tree branch.
+
+    Returns
+    -------
+    rel_means: Series
+        The input with the blended relative means of the two branches.
+    """
     b1, b2 = branches
     timezones = tree.populate_timezone()
     assignments = assign_branches(tree.branch_times(), timezones)
@@ -261,13 +355,17 @@ def commited_branches(tree, branches, rel_means):
     offsets = np.array([tree.branch_times()[branch][0] for branch in branches])
     mix = np.array(timezones[matches]) - offsets
     mix_range = np.arange(mix[0], mix[1] + 1)
-    component_other = np.arange(0, 0.5, 1 / (2 * len(mix_range)))[::-1]
-    component_self = 1 - component_other
-    rel_means[b1] = ((component_self * rel_means[b1][mix_range].transpose()) +
-                     (component_other * rel_means[b2][mix_range].transpose())).transpose()
-
-    rel_means[b2] = ((component_self * rel_means[b2][mix_range].transpose()) +
-                     (component_other * rel_means[b1][mix_range].transpose())).transpose()
+    length = len(mix_range)
+    component_self = (0.5 + np.arange(1, length + 1) / (2 * length))[:, np.newaxis]
+
+    # take both blocks before writing, so that the second branch is blended
+    # with the original (not the already blended) first branch
+    block1 = rel_means[b1][mix_range]
+    block2 = rel_means[b2][mix_range]
+    rel_means[b1] = rel_means[b1].copy()
+    rel_means[b2] = rel_means[b2].copy()
+    rel_means[b1][mix_range] = component_self * block1 + (1 - component_self) * block2
+    rel_means[b2][mix_range] = component_self * block2 + (1 - component_self) * block1
     return rel_means
 
 
@@ -357,10 +455,25 @@ def pick_branches(tree, pseudotime):
     """
     timezone = tree.populate_timezone()
     assignments = assign_branches(tree.branch_times(), timezone)
-    branch_type = type(tree.branches[0])
-    branches = np.array([tree.branches[0]] * len(pseudotime))
-    for n, t in enumerate(pseudotime):
-        branches[n] = pick_branch(tree, t, timezone, assignments)
+    pseudotime = np.asarray(pseudotime)
+
+    # direct lookup table from pseudotime to timezone
+    zone_of_time = np.zeros(max(zone[1] for zone in timezone) + 1, dtype=int)
+    for i, zone in enumerate(timezone):
+        zone_of_time[zone[0]:zone[1] + 1] = i
+    zones = zone_of_time[pseudotime]
+
+    branches = np.empty(len(pseudotime), dtype=np.array(tree.branches).dtype)
+    for i in np.unique(zones):
+        cells = np.where(zones == i)[0]
+        possibilities = np.array(assignments[i])
+        where_in_branch = pseudotime[cells] - timezone[i][0]
+        densities = np.array([tree.density[b][where_in_branch] for b in possibilities])
+        # inverse transform sampling for all cells of the timezone at once
+        cumulative = np.cumsum(densities, axis=0)
+        cumulative /= cumulative[-1]
+        choice = np.sum(random.random(len(cells)) >= cumulative, axis=0)
+        branches[cells] = possibilities[np.minimum(choice, len(possibilities) - 1)]
     return branches
 
 
@@ -422,7 +535,9 @@ def max_relat_exp(tree, relative_means):
     """
     maxes = np.zeros((tree.G, len(tree.branches)))
     for i, branch in enumerate(tree.branches):
-        maxes[:, i] = np.max(np.exp(relative_means[branch]), axis=0)
+        # exp is monotonic, so exponentiate the column maxima instead of the
+        # whole matrix
+        maxes[:, i] = np.exp(np.max(relative_means[branch], axis=0))
     return maxes
 
 
@@ -455,17 +570,15 @@ def simulate_base_gene_exp(tree, relative_means, abs_max=5000, gene_mean=0.8, ge
     """
     base_gene_exp = np.zeros(tree.G)
 
-    log_generator = sp.stats.norm(loc=gene_mean, scale=gene_std)
-
     max_gene_per_branch = max_relat_exp(tree, relative_means)
     max_per_gene = np.max(max_gene_per_branch, axis=1)
 
     for gene in range(tree.G):
-        tmp = np.exp(log_generator.rvs())
+        tmp = np.exp(random.normal(loc=gene_mean, scale=gene_std))
         counter = 0
         while tmp * max_per_gene[gene] > abs_max:
             counter = counter + 1
-            tmp = np.exp(log_generator.rvs())
+            tmp = np.exp(random.normal(loc=gene_mean, scale=gene_std))
         base_gene_exp[gene] = tmp
     return base_gene_exp
 
@@ -492,7 +605,7 @@ def calc_scalings(cells, scale=True, scale_mean=0, scale_v=0.7):
         A library size factor for each cell
     """
     if scale:
-        scalings = np.exp(sp.stats.norm.rvs(loc=scale_mean, scale=scale_v, size=cells))
+        scalings = np.exp(random.normal(loc=scale_mean, scale=scale_v, size=cells))
     else:
         scalings = np.ones(cells)
     return scalings
@@ -627,7 +740,8 @@ def adjust_to_parent(relative_means, current, topology):
     Returns
     -------
     res: numpy.ndarray
-        Adjusted relative expression matrix for the current branch.
+        Adjusted relative expression matrix for the current branch (adjusted in
+        place).
     """
     parent_loc = (topology[:, 1] == current)
     if not np.any(parent_loc):
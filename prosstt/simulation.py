@@ -6,13 +6,13 @@
 genes, and different sampling strategies for (pseudotime, branch) pairs.
 """
 
-import sys
 import warnings
 
 import numpy as np
 from numpy import random
 import pandas as pd
-import scipy as sp
+from scipy import sparse
+from scipy.signal import lfilter
 
 from prosstt import sim_utils as sut
 from prosstt import count_model as cm
@@ -34,8 +34,9 @@ def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100):
     new diffusion correlates with any of the older ones. If the correlation is
     too high (above 0.5 per default), the last diffusion process will be
     replaced with a new one until one is found that does not correlate with any
-    other columns of W or a suitable replacement hasn't been found after 100
-    tries.
+    other columns of W. If no suitable replacement has been found after
+    max_loops tries, the least correlated candidate is kept and a warning is
+    issued.
 
     Obviously this gets more probable the higher the number of components is -
     it might be advisable to change the number of maximum loops allowed or
@@ -54,34 +55,49 @@ def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100):
     max_loops: int, optional
         The maximum number of times the method will try simulating a new
         diffusion process that doesn't correlate with all previous ones in W
-        before resetting the matrix and starting over
+        before it keeps the least correlated of the rejected candidates
 
     Returns
     -------
     W: ndarray
         Output array
     """
-    programs = np.zeros((expr_progr, branch_length))
+    # single precision is plenty for log-space relative expression and halves
+    # the memory traffic of the programs x coefficients product
+    programs = np.zeros((expr_progr, branch_length), dtype=np.float32)
+    # keep the accepted programs centered and normalized, so that testing a
+    # new candidate only costs a matrix-vector product
+    normalized = np.zeros((expr_progr, branch_length))
     k = 0
     loops = 0
+    best_correlation = np.inf
     while k < expr_progr:
-        programs[k] = diffusion(branch_length)
+        candidate = diffusion(branch_length)
+        candidate_normalized = sut.normalize_rows(candidate)
 
-        correlates = sut.test_correlation(programs, k, cutoff)
-        if correlates:
-            # repeat and hope it works better this time
+        correlation = sut.max_correlation(normalized[:k], candidate_normalized)
+        if correlation > cutoff:
             loops += 1
-            continue
-        else:
-            loops = 0
-            k += 1
-
-        if loops > max_loops:
+            if correlation < best_correlation:
+                best = (candidate, candidate_normalized)
+                best_correlation = correlation
+            if loops <= max_loops:
+                # repeat and hope it works better this time
+                continue
             # we tried so hard
             # and came so far
             # but in the end
             # it doesn't even matter
-            return sim_expr_branch(branch_length, expr_progr, cutoff=cutoff)
+            warnings.warn("No expression program with a correlation below %s found "
+                          "after %i tries; keeping the least correlated one" %
+                          (cutoff, max_loops), UserWarning)
+            candidate, candidate_normalized = best
+
+        programs[k] = candidate
+        normalized[k] = candidate_normalized
+        loops = 0
+        best_correlation = np.inf
+        k += 1
 
     return np.transpose(programs)
 
@@ -101,25 +117,19 @@ def diffusion(steps):
     walk: float array
         A diffusion process with a specified number of steps.
     """
-    velocity = np.zeros(steps)
-    walk = np.zeros(steps)
-
-    walk[0] = np.log(sp.stats.uniform.rvs(0, 1.5))
-    # walk[0] = 0
-    velocity[0] = sp.stats.norm.rvs(loc=0, scale=0.2)
+    walk_start = np.log(random.uniform(0, 1.5))
+    velocity_start = random.normal(loc=0, scale=0.2)
 
     s_eps = 2 / steps
-    eta = sp.stats.uniform.rvs()
-
-    for t in range(0, steps - 1):
-        walk[t + 1] = walk[t] + velocity[t]
+    eta = random.uniform()
+    epsilon = random.normal(loc=0, scale=s_eps, size=steps - 1)
 
-        epsilon = sp.stats.norm.rvs(loc=0, scale=s_eps)
-        # amortize the update
-        # velocity[t + 1] = 0.9 * velocity[t] + epsilon - eta * velocity[t]
-        # velocity[t + 1] = 0.95 * velocity[t] + epsilon
-        velocity[t + 1] = eta * velocity[t] + epsilon
-        # velocity[t + 1] = eta * velocity[t] + epsilon
+    # the amortized update velocity[t + 1] = eta * velocity[t] + epsilon[t]
+    # is a first order linear recurrence, i.e. an IIR filter over the noise
+    velocity = lfilter([1.], [1., -eta], np.concatenate(([velocity_start], epsilon)))
+    walk = np.empty(steps)
+    walk[0] = walk_start
+    walk[1:] = walk_start + np.cumsum(velocity[:-1])
 
     return walk
 
@@ -170,7 +180,7 @@ def _sim_coeff_beta(tree, groups, a=2, b=2):
     ----------
     tree: Tree
         A lineage tree
-    groups: list of ints
+    groups: list of int arrays
         A list of the two modules to which each gene belongs
     a: float, optional
         First shape parameter of the Beta distribution
@@ -182,10 +192,11 @@ def _sim_coeff_beta(tree, groups, a=2, b=2):
     H: ndarray
         Output array
     """
-    H = np.zeros((tree.modules, tree.G))
-    for k in range(tree.modules):
-        for gene in groups[k]:
-            H[k][gene] += sp.stats.beta.rvs(a, b)
+    programs = np.repeat(np.arange(len(groups)), [len(group) for group in groups])
+    genes = np.concatenate(groups).astype(int, copy=False)
+    H = np.zeros((tree.modules, tree.G), dtype=np.float32)
+    # add.at accumulates genes that were assigned to the same module twice
+    np.add.at(H, (programs, genes), random.beta(a, b, size=len(genes)))
     return H
 
 
@@ -208,8 +219,8 @@ def _sim_coeff_gamma(tree, a=0.05):
     """
     K = tree.modules
     G = tree.G
-    coefficients = np.reshape(sp.stats.gamma.rvs(a, size=K * G), (K, G))
-    return coefficients
+    coefficients = np.reshape(random.gamma(a, size=K * G), (K, G))
+    return coefficients.astype(np.float32)
 
 
 def simulate_lineage(tree, rel_exp_cutoff=8, intra_branch_tol=0.5,
@@ -317,7 +328,8 @@ def sample_whole_tree_restricted(tree, alpha=0.2, beta=3):
 
 
 def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
-                             beta=2, scale=True, scale_mean=0, scale_v=0.7):
+                             beta=2, scale=True, scale_mean=0, scale_v=0.7,
+                             as_sparse=False):
     """
     Simulate the expression matrix of a differentiation if the data came from
     a time series experiment.
@@ -353,10 +365,13 @@ def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
         Mean of the library size log-normal distribution
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    as_sparse: bool, optional
+        Return the expression matrix as a scipy.sparse CSR matrix, which saves
+        memory for large count matrices that are mostly zero
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -376,7 +391,7 @@ def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
     pseudotimes = np.array(pseudotimes)
     return _sample_data_at_times(tree, pseudotimes, alpha=alpha, beta=beta,
                                  scale=scale, scale_mean=scale_mean,
-                                 scale_v=scale_v)
+                                 scale_v=scale_v, as_sparse=as_sparse)
 
 
 def draw_times(timepoint, no_cells, max_time, var=4):
@@ -406,15 +421,14 @@ def draw_times(timepoint, no_cells, max_time, var=4):
     sample_pt: int array
         Pseudotime points around <timepoint>.
     """
-    sample_pt = sp.stats.norm.rvs(loc=timepoint, scale=var, size=no_cells)
+    sample_pt = random.normal(loc=timepoint, scale=var, size=no_cells)
     sample_pt = sample_pt.astype(int)
-    sample_pt[sample_pt < 0] = 0
-    sample_pt[sample_pt >= max_time] = max_time - 1
+    np.clip(sample_pt, 0, max_time - 1, out=sample_pt)
     return sample_pt
 
 
 def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True,
-                   scale_v=0.7, scale_mean=0.):
+                   scale_v=0.7, scale_mean=0., as_sparse=False):
     """
     Use cell density along the lineage tree to sample pseudotime/branch pairs
     for the expression matrix.
@@ -437,10 +451,13 @@ def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True,
         Mean of the log-normal library size distribution
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    as_sparse: bool, optional
+        Return the expression matrix as a scipy.sparse CSR matrix, which saves
+        memory for large count matrices that are mostly zero
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -468,11 +485,12 @@ def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True,
 
     return _sample_data_at_times(tree, sample_time, alpha=alpha, beta=beta,
                                  branches=sample_branches, scale=scale,
-                                 scale_mean=scale_mean, scale_v=scale_v)
+                                 scale_mean=scale_mean, scale_v=scale_v,
+                                 as_sparse=as_sparse)
 
 
 def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True,
-                      scale_mean=0., scale_v=0.7):
+                      scale_mean=0., scale_v=0.7, as_sparse=False):
     """
     Every possible pseudotime/branch pair on the lineage tree is sampled a
     number of times.
@@ -495,10 +513,13 @@ def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True,
         Mean of the log-normal library size distribution
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    as_sparse: bool, optional
+        Return the expression matrix as a scipy.sparse CSR matrix, which saves
+        memory for large count matrices that are mostly zero
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -514,7 +535,8 @@ def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True,
 
     return _sample_data_at_times(tree, pseudotime, alpha=alpha, beta=beta,
                                  branches=branches, scale=scale,
-                                 scale_mean=scale_mean, scale_v=scale_v)
+                                 scale_mean=scale_mean, scale_v=scale_v,
+                                 as_sparse=as_sparse)
 
 
 def cover_whole_tree(tree):
@@ -549,7 +571,8 @@ def cover_whole_tree(tree):
 
 
 def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
-                          scale=True, scale_mean=0., scale_v=0.7):
+                          scale=True, scale_mean=0., scale_v=0.7,
+                          as_sparse=False):
     """
     Sample cells from the lineage tree for given pseudotimes. If branch
     assignments are not specified, cells will be randomly assigned to one of the
@@ -575,10 +598,13 @@ def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
         Mean of the log-normal library size distribution
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    as_sparse: bool, optional
+        Return the expression matrix as a scipy.sparse CSR matrix, which saves
+        memory for large count matrices that are mostly zero
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -595,11 +621,13 @@ def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
     if branches is None:
         branches = sut.pick_branches(tree, sample_pt)
     scalings = sut.calc_scalings(no_cells, scale, scale_mean, scale_v)
-    expr_matrix = draw_counts(tree, sample_pt, branches, scalings, alpha, beta)
+    expr_matrix = draw_counts(tree, sample_pt, branches, scalings, alpha, beta,
+                              as_sparse=as_sparse)
     return expr_matrix, sample_pt, branches, scalings
 
 
-def draw_counts(tree, pseudotime, branches, scalings, alpha, beta):
+def draw_counts(tree, pseudotime, branches, scalings, alpha, beta,
+                chunk_size=1000, as_sparse=False):
     """
     For all the cells in the lineage tree described by a given pseudotime and
     branch assignment, sample UMI count values for all genes. Each cell is an
@@ -622,52 +650,83 @@ def draw_counts(tree, pseudotime, branches, scalings, alpha, beta):
     beta: float or ndarray
         Parameter for the count-drawing distribution. Float if it is the same
         for all genes, else an ndarray
+    chunk_size: int, optional
+        Number of cells whose counts are sampled together. Bounds the memory
+        used for the negative binomial parameters
+    as_sparse: bool, optional
+        Return the expression matrix as a scipy.sparse CSR matrix. Each block
+        of cells is compressed right after sampling, so the dense matrix is
+        never allocated
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     """
-    no_cells = len(branches)
-
-    cell_avg_exp = np.zeros((no_cells, tree.G))
-    offsets = [tree.branch_times()[branch][0] for branch in branches]
-    cell_times = pseudotime - offsets
-    p_total = np.zeros(no_cells * tree.G)
-    r_total = np.zeros(no_cells * tree.G)
-
-    for n, time, branch in zip(np.arange(no_cells), cell_times, branches):
-        cell_avg_exp[n] = tree.means[branch][time] * scalings[n]
-
-    for cell in range(no_cells):
-        p, r = cm.get_pr_umi(a=alpha, b=beta, m=cell_avg_exp[cell])
-        p_total[cell * tree.G:(cell + 1) * tree.G] = p
-        r_total[cell * tree.G:(cell + 1) * tree.G] = r
+    branch_times = tree.branch_times()
+
+    # lay the means of all branches out in one contiguous array, so that the
+    # average expression of every cell is gathered with a single fancy index
+    stacked_means = np.concatenate([tree.means[b] for b in tree.branches])
+    branch_lengths = [len(tree.means[b]) for b in tree.branches]
+    first_row = dict(zip(tree.branches, np.cumsum([0] + branch_lengths[:-1])))
+
+    names, which = np.unique(branches, return_inverse=True)
+    starts = np.array([branch_times[b][0] for b in names])
+    lengths = np.array([len(tree.means[b]) for b in names])
+    cell_times = np.asarray(pseudotime) - starts[which]
+    outside = (cell_times < 0) | (cell_times >= lengths[which])
+    if np.any(outside):
+        cell = np.argmax(outside)
+        start, end = branch_times[branches[cell]]
+        msg = "Cell %i has pseudotime %i, which lies outside of its branch %s " \
+              "(pseudotime %i to %i)" % (cell, pseudotime[cell], branches[cell],
+                                         start, end)
+        raise ValueError(msg)
+    rows = cell_times + np.array([first_row[b] for b in names])[which]
+    scalings = np.asarray(scalings)
+    alpha = np.asarray(alpha)
+    beta = np.asarray(beta)
+
+    # without library size differences all cells at the same position of the
+    # tree share p, r, so they are computed once per row of the tree
+    shared_scaling = len(scalings) > 0 and np.all(scalings == scalings[0])
+    if shared_scaling:
+        p_rows, r_rows = cm.get_pr_umi(a=alpha, b=beta, m=stacked_means * scalings[0])
+
+    # sample a block of cells at a time so that the average expression and
+    # the p, r temporaries never grow to the size of the whole matrix
+    if as_sparse:
+        blocks = []
+    else:
+        expr_matrix = np.zeros((len(rows), tree.G), dtype=int)
+    for start in range(0, len(rows), chunk_size):
+        block = slice(start, start + chunk_size)
+        if shared_scaling:
+            p, r = p_rows[rows[block]], r_rows[rows[block]]
+        else:
+            cell_avg_exp = stacked_means[rows[block]] * scalings[block, np.newaxis]
+            p, r = cm.get_pr_umi(a=alpha, b=beta, m=cell_avg_exp)
+        if as_sparse:
+            blocks.append(sparse.csr_matrix(cm.sample_negbin(p, r)))
+        else:
+            expr_matrix[block] = cm.sample_negbin(p, r)
 
-    nbinom = sp.stats.nbinom(n=r_total, p=(1 - p_total))
-    expr_matrix = nbinom.rvs()
-    # custm = cm.my_negbin()
-    # expr_matrix = custm.rvs(p_total, r_total)
-    return expr_matrix.reshape((no_cells, tree.G))
+    if as_sparse:
+        if not blocks:
+            return sparse.csr_matrix((0, tree.G), dtype=int)
+        return sparse.vstack(blocks, format="csr")
+    return expr_matrix
 
 
 def add_non_diff_genes(inform_expr_matrix, genes, gene_params, cell_scalings):
     N, G = inform_expr_matrix.shape
 
-    p_total = np.zeros(N * genes)
-    r_total = np.zeros(N * genes)
-
-    for cell in range(N):
-        mu_cell = cell_scalings[cell] * gene_params["base_expr"]
-        p, r = cm.get_pr_umi(a=gene_params["alpha"],
-                             b=gene_params["beta"],
-                             m=mu_cell)
-        p_total[cell * genes:(cell + 1) * genes] = p
-        r_total[cell * genes:(cell + 1) * genes] = r
-
-    nbinom = sp.stats.nbinom(n=r_total, p=(1 - p_total))
-    noninform_expr_matrix = nbinom.rvs()
-    noninform_expr_matrix = noninform_expr_matrix.reshape((N, genes))
+    mu = np.outer(cell_scalings, gene_params["base_expr"])
+    p, r = cm.get_pr_umi(a=np.asarray(gene_params["alpha"]),
+                         b=np.asarray(gene_params["beta"]),
+                         m=mu)
+    noninform_expr_matrix = cm.sample_negbin(p, r)
 
     fusion = np.zeros((N, G + genes))
     fusion[:, 0:G] = inform_expr_matrix
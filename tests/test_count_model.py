@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests for the negative binomial count model.
+"""
+
+import numpy as np
+
+from prosstt import count_model as cm
+
+
+def test_sample_negbin_moments():
+    """
+    Sampled counts have mean m and variance a*m^2 + b*m.
+    """
+    np.random.seed(42)
+    draws = 200000
+    for a, b, m in [(0.2, 2, 5.), (0.5, 3, 50.), (0.1, 1.5, 0.7)]:
+        p, r = cm.get_pr_umi(a=np.array([a]), b=np.array([b]),
+                             m=np.full(draws, m))
+        counts = cm.sample_negbin(p, r)
+        assert np.isclose(np.mean(counts), m, rtol=0.02)
+        assert np.isclose(np.var(counts), a * m**2 + b * m, rtol=0.05)
+
+
+def test_sample_negbin_zero_mean():
+    """
+    Entries with r == 0 (zero mean expression) are always 0.
+    """
+    np.random.seed(42)
+    p = np.array([0., 0.5, 0., 0.9])
+    r = np.array([0., 2., 0., 10.])
+    counts = cm.sample_negbin(p, r)
+    assert counts.shape == r.shape
+    assert np.all(counts[r == 0] == 0)
+    assert np.all(counts >= 0)